@@ -1,109 +1,101 @@
 #!/usr/bin/env python
 
+from concurrent.futures import ThreadPoolExecutor
 from configparser import ConfigParser
+from datetime import datetime, time
 from urllib import parse
+from zoneinfo import ZoneInfo
 
 import click
 import maya
 import requests
 from influxdb import InfluxDBClient
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+# largest page the Octopus API will return, a year of half-hourly readings
+# fits in a single request
+PAGE_SIZE = 25000
+# points per InfluxDB write request
+WRITE_BATCH_SIZE = 5000
 
-def retrieve_paginated_data(
-        api_key, url, from_date, to_date, page=None
-):
+
+def retrieve_paginated_data(session, url, from_date, to_date):
     args = {
         'period_from': from_date,
         'period_to': to_date,
+        'page_size': PAGE_SIZE,
     }
-    if page:
-        args['page'] = page
-    response = requests.get(url, params=args, auth=(api_key, ''))
-    response.raise_for_status()
-    data = response.json()
-    results = data.get('results', [])
-    if data['next']:
+    results = []
+    while True:
+        response = session.get(url, params=args)
+        response.raise_for_status()
+        data = response.json()
+        results.extend(data.get('results', []))
+        if not data['next']:
+            return results
         url_query = parse.urlparse(data['next']).query
-        next_page = parse.parse_qs(url_query)['page'][0]
-        results += retrieve_paginated_data(
-            api_key, url, from_date, to_date, next_page
-        )
-    return results
+        args['page'] = parse.parse_qs(url_query)['page'][0]
+
+
+def parse_iso8601(value):
+    # datetime.fromisoformat only accepts a trailing 'Z' from Python 3.11
+    return datetime.fromisoformat(value.replace('Z', '+00:00'))
 
 
-def store_series(connection, series, metrics, rate_data):
+def series_lines(series, metrics, rate_data):
 
     agile_data = rate_data.get('agile_unit_rates', [])
     agile_rates = {
-        point['valid_to']: point['value_inc_vat']
+        int(parse_iso8601(point['valid_to']).timestamp()):
+            point['value_inc_vat']
         for point in agile_data
     }
 
+    conversion_factor = rate_data.get('conversion_factor', None)
+    standing_charge = rate_data['standing_charge'] / 48  # 30 minute reads
+    if agile_data:
+        agile_standing_charge = rate_data['agile_standing_charge'] / 48
+
+    low_zone = rate_data.get('unit_rate_low_zone')
+    if low_zone:
+        low_tz = ZoneInfo(low_zone)
+        low_start = time.fromisoformat(rate_data['unit_rate_low_start'])
+        low_start = low_start.hour * 60 + low_start.minute
+        low_end = time.fromisoformat(rate_data['unit_rate_low_end'])
+        low_end = low_end.hour * 60 + low_end.minute
+
     def active_rate_field(measurement):
         if series == 'gas':
             return 'unit_rate'
-        elif not rate_data['unit_rate_low_zone']:  # no low rate
+        elif not low_zone:  # no low rate
             return 'unit_rate_high'
 
-        low_start_str = rate_data['unit_rate_low_start']
-        low_end_str = rate_data['unit_rate_low_end']
-        low_zone = rate_data['unit_rate_low_zone']
-
-        measurement_at = maya.parse(measurement['interval_start'])
-
-        low_start = maya.when(
-            measurement_at.datetime(to_timezone=low_zone).strftime(
-                f'%Y-%m-%dT{low_start_str}'
-            ),
-            timezone=low_zone
-        )
-        low_end = maya.when(
-            measurement_at.datetime(to_timezone=low_zone).strftime(
-                f'%Y-%m-%dT{low_end_str}'
-            ),
-            timezone=low_zone
-        )
+        measurement_at = parse_iso8601(
+            measurement['interval_start']
+        ).astimezone(low_tz)
+        now = measurement_at.hour * 60 + measurement_at.minute
         if low_start > low_end:
             # end time is the following day
-            low_end_d1 = maya.when(
-                measurement_at.datetime(to_timezone=low_zone).strftime(
-                    f'%Y-%m-%dT23:59:59'
-                ),
-                timezone=low_zone
-            )
-            low_start_d2 = maya.when(
-                measurement_at.datetime(to_timezone=low_zone).strftime(
-                    f'%Y-%m-%dT00:00:00'
-                ),
-                timezone=low_zone
-            )
-            low_period_a = maya.MayaInterval(low_start, low_end_d1)
-            low_period_b = maya.MayaInterval(low_start_d2, low_end)
+            is_low = low_start <= now or now < low_end
         else:
-            low_period_a = low_period_b = maya.MayaInterval(low_start, low_end)
-        return \
-            'unit_rate_low' if measurement_at in low_period_a \
-                or measurement_at in low_period_b \
-            else 'unit_rate_high'
+            is_low = low_start <= now < low_end
+        return 'unit_rate_low' if is_low else 'unit_rate_high'
 
-    def fields_for_measurement(measurement):
+    def fields_for_measurement(measurement, timestamp, rate):
         consumption = measurement['consumption']
-        conversion_factor = rate_data.get('conversion_factor', None)
         if conversion_factor:
             consumption *= conversion_factor
-        rate = active_rate_field(measurement)
         rate_cost = rate_data[rate]
         cost = consumption * rate_cost
-        standing_charge = rate_data['standing_charge'] / 48  # 30 minute reads
         fields = {
             'consumption': consumption,
             'cost': cost,
             'total_cost': cost + standing_charge,
         }
         if agile_data:
-            agile_standing_charge = rate_data['agile_standing_charge'] / 48
             agile_unit_rate = agile_rates.get(
-                maya.parse(measurement['interval_end']).iso8601(),
+                timestamp,
                 rate_data[rate]  # cludge, use Go rate during DST changeover
             )
             agile_cost = agile_unit_rate * consumption
@@ -114,24 +106,25 @@ def store_series(connection, series, metrics, rate_data):
             })
         return fields
 
-    def tags_for_measurement(measurement):
-        period = maya.parse(measurement['interval_end'])
-        time = period.datetime().strftime('%H:%M')
-        return {
-            'active_rate': active_rate_field(measurement),
-            'time_of_day': time,
-        }
+    def line_for_measurement(measurement):
+        # measurement,tag=value,... field=value,... timestamp
+        timestamp = int(parse_iso8601(measurement['interval_end']).timestamp())
+        # UTC time of day, straight from the epoch seconds
+        hour, minute = timestamp // 3600 % 24, timestamp // 60 % 60
+        time_of_day = f'{hour:02d}:{minute:02d}'
+        rate = active_rate_field(measurement)
+        fields = ','.join(
+            f'{field}={float(value)!r}'
+            for field, value in fields_for_measurement(
+                measurement, timestamp, rate
+            ).items()
+        )
+        return (
+            f'{series},active_rate={rate},'
+            f'time_of_day={time_of_day} {fields} {timestamp}'
+        )
 
-    measurements = [
-        {
-            'measurement': series,
-            'tags': tags_for_measurement(measurement),
-            'time': measurement['interval_end'],
-            'fields': fields_for_measurement(measurement),
-        }
-        for measurement in metrics
-    ]
-    connection.write_points(measurements)
+    return [line_for_measurement(measurement) for measurement in metrics]
 
 
 @click.command()
@@ -158,6 +151,9 @@ def cmd(config_file, from_date, to_date):
     api_key = config.get('octopus', 'api_key')
     if not api_key:
         raise click.ClickException('No Octopus API key set')
+    parallelism = config.getint('octopus', 'parallelism', fallback=3)
+    if parallelism < 1:
+        raise click.ClickException('octopus parallelism must be at least 1')
 
     e_mpan = config.get('electricity', 'mpan', fallback=None)
     e_serial = config.get('electricity', 'serial_number', fallback=None)
@@ -169,9 +165,11 @@ def cmd(config_file, from_date, to_date):
 
     g_mpan = config.get('gas', 'mpan', fallback=None)
     g_serial = config.get('gas', 'serial_number', fallback=None)
-    g_meter_type = config.get('gas', 'meter_type', fallback=1)
-    g_vcf = config.get('gas', 'volume_correction_factor', fallback=1.02264)
-    g_cv = config.get('gas', 'calorific_value', fallback=40)
+    g_meter_type = config.getint('gas', 'meter_type', fallback=1)
+    g_vcf = config.getfloat(
+        'gas', 'volume_correction_factor', fallback=1.02264
+    )
+    g_cv = config.getfloat('gas', 'calorific_value', fallback=40.0)
     if not g_mpan or not g_serial:
         raise click.ClickException('No gas meter identifiers')
     g_url = 'https://api.octopus.energy/v1/gas-meter-points/' \
@@ -208,40 +206,60 @@ def cmd(config_file, from_date, to_date):
             ),
             'unit_rate': config.getfloat('gas', 'unit_rate', fallback=0.0),
             # SMETS1 meters report kWh, SMET2 report m^3 and need converting to kWh first
-            'conversion_factor': (float(g_vcf) * float(g_cv)) / 3.6 if int(g_meter_type) > 1 else None,
+            'conversion_factor': g_vcf * g_cv / 3.6 if g_meter_type > 1 else None,
         }
     }
 
     from_iso = maya.when(from_date, timezone=timezone).iso8601()
     to_iso = maya.when(to_date, timezone=timezone).iso8601()
 
+    session = requests.Session()
+    session.auth = (api_key, '')
+    # keep-alive connections are pooled per host, retry transient failures
+    # rather than abandoning the run
+    session.mount('https://', HTTPAdapter(
+        pool_maxsize=parallelism,
+        max_retries=Retry(
+            total=3,
+            backoff_factor=0.2,
+            status_forcelist=(429, 500, 502, 503, 504),
+        ),
+    ))
+
     click.echo(
-        f'Retrieving electricity data for {from_iso} until {to_iso}...',
+        f'Retrieving electricity data, Agile rates and gas data for '
+        f'{from_iso} until {to_iso}...',
         nl=False
     )
-    e_consumption = retrieve_paginated_data(
-        api_key, e_url, from_iso, to_iso
-    )
-    click.echo(f' {len(e_consumption)} readings.')
+    # the three requests are independent, so overlap their network time
+    with ThreadPoolExecutor(max_workers=parallelism) as executor:
+        e_future = executor.submit(
+            retrieve_paginated_data, session, e_url, from_iso, to_iso
+        )
+        if agile_url:  # Agile comparison is optional
+            agile_future = executor.submit(
+                retrieve_paginated_data, session, agile_url, from_iso, to_iso
+            )
+        g_future = executor.submit(
+            retrieve_paginated_data, session, g_url, from_iso, to_iso
+        )
+    e_consumption = e_future.result()
+    if agile_url:
+        rate_data['electricity']['agile_unit_rates'] = agile_future.result()
+    g_consumption = g_future.result()
     click.echo(
-        f'Retrieving Agile rates for {from_iso} until {to_iso}...',
-        nl=False
-    )
-    rate_data['electricity']['agile_unit_rates'] = retrieve_paginated_data(
-        api_key, agile_url, from_iso, to_iso
+        f' {len(e_consumption)} electricity readings,'
+        f' {len(rate_data["electricity"]["agile_unit_rates"])} Agile rates,'
+        f' {len(g_consumption)} gas readings.'
     )
-    click.echo(f' {len(rate_data["electricity"]["agile_unit_rates"])} rates.')
-    store_series(influx, 'electricity', e_consumption, rate_data['electricity'])
 
-    click.echo(
-        f'Retrieving gas data for {from_iso} until {to_iso}...',
-        nl=False
-    )
-    g_consumption = retrieve_paginated_data(
-        api_key, g_url, from_iso, to_iso
+    # one write for both series keeps the batches as full as possible
+    lines = series_lines('electricity', e_consumption, rate_data['electricity'])
+    lines += series_lines('gas', g_consumption, rate_data['gas'])
+    influx.write_points(
+        lines, time_precision='s', batch_size=WRITE_BATCH_SIZE,
+        protocol='line'
     )
-    click.echo(f' {len(g_consumption)} readings.')
-    store_series(influx, 'gas', g_consumption, rate_data['gas'])
 
 
 if __name__ == '__main__':